@@ -6,160 +6,278 @@ https://github.com/ukc-co663/depsolver
 # https://packages.ubuntu.com/xenial/python3
 import argparse
 import bisect
+import heapq
+import io
+import itertools
 import json
-import re
+import operator
 import subprocess
 import sys
-import types
-
-SAT_NUMBER = [None]
-"""A list of every package, where the list index is the package's SAT number.
-
-Index 0 is None.
-"""
 
 UNINSTALL_COST = 10**6
 UNINSTALL_COST_STR = str(UNINSTALL_COST) + " "
 MAX_WEIGHT = UNINSTALL_COST ** 2
 MAX_WEIGHT_STR = str(MAX_WEIGHT) + " "
 
+get_sat_number = operator.attrgetter("sat_number")
+get_size = operator.attrgetter("size")
+
+CONSTRAINT_CACHE = {}
+"""A dictionary mapping constraint strings to their Constraint objects."""
+
+VERSION_CACHE = {}
+"""A dictionary mapping version strings to their version tuples."""
+
 
 class ToposortError(Exception):
-    """Unable to toposort the solution."""
+    """Unable to toposort the solution.
+
+    cycles is a list of the cycles in the graph, each a sorted list of nodes.
+    """
+
+    def __init__(self, cycles=()):
+        super().__init__()
+        self.cycles = cycles
 
 
 class SATError(Exception):
     """SAT solver failed."""
 
 
-class Package(types.SimpleNamespace):
+class CNF:
+    """Container class representing a problem in DIMACS CNF form, or Weighted
+    Partial Max-SAT form if top_weight is set, for passing to a SAT solver.
+
+    Clauses are written straight to a buffer with add_clause or add_clauses,
+    which count them, and the comment and problem lines are only added by
+    str(), so the problem line always matches the clauses written.
+    """
+    __slots__ = ("comment", "variables", "top_weight", "clause_count",
+                 "buffer")
+
+    def __init__(self, comment, variables=0, top_weight=None):
+        self.comment = comment
+        self.variables = variables
+        self.top_weight = top_weight
+        self.clause_count = 0
+        self.buffer = io.StringIO()
+
+    def add_clause(self, clause):
+        """Writes a clause, given as a string of (weight and) literals."""
+        self.buffer.write(clause)
+        self.buffer.write(" 0\n")
+        self.clause_count += 1
+
+    def add_clauses(self, clauses):
+        """Writes an iterable of clauses, each given as a string of (weight
+        and) literals.
+        """
+        write = self.buffer.write
+        count = 0
+        for clause in clauses:
+            write(clause + " 0\n")
+            count += 1
+        self.clause_count += count
+
+    def __str__(self):
+        if self.top_weight is None:
+            problem_line = "p cnf {} {} \n".format(
+                self.variables, self.clause_count)
+        else:
+            problem_line = "p wcnf {} {} {}\n".format(
+                self.variables, self.clause_count, self.top_weight)
+        return ("c " + self.comment + "\n" + problem_line
+                + self.buffer.getvalue())
+
+
+class Package:
     """Container class representing a package.
 
     find_constraint_options must be called to populate conflicts and
     dependencies.
     """
-    def __init__(self, package_data):
+    __slots__ = ("name", "version", "size", "dependency_constraints",
+                 "dependencies", "dependency_sat_numbers",
+                 "conflict_constraints", "conflicts", "sat_number", "_str")
+
+    def __init__(self, package_data, sat_number):
         self.name = package_data["name"]
-        self.version = [int(part) for part in
-                        package_data["version"].split(".")]
+        self.version = parse_version(package_data["version"])
         self.size = package_data["size"]
+        # used for every command, so only build it once
+        self._str = self.name + "=" + ".".join(map(str, self.version))
 
         if "depends" in package_data:
             self.dependency_constraints = self.parse_dependency_constraints(
                 package_data["depends"])
         else:
-            self.dependency_constraints = []
+            self.dependency_constraints = ()
         self.dependencies = None
+        self.dependency_sat_numbers = None
 
         if "conflicts" in package_data:
-            self.conflict_constraints = [
-                Constraint(conflict_data)
-                for conflict_data in package_data["conflicts"]
-            ]
+            self.conflict_constraints = tuple(
+                make_constraint(conflict_data)
+                for conflict_data in package_data["conflicts"])
         else:
-            self.conflict_constraints = []
+            self.conflict_constraints = ()
         self.conflicts = None
 
-        # register self as a number to be used in SAT solver
-        global SAT_NUMBER
-        SAT_NUMBER.append(self)
-        self.sat_number = len(SAT_NUMBER) - 1
+        # number to be used in SAT solver
+        self.sat_number = sat_number
 
     def parse_dependency_constraints(self, dependency_data):
-        """Parses a list of dependency data into a list of Constraint objects.
+        """Parses a list of dependency data into a tuple of Constraint
+        objects.
+
+        Dependency data is a list of lists (one level deep), where each inner
+        list holds the alternatives of one dependency. A plain string is a
+        dependency with a single alternative. These become tuples, so that
+        packages with the same constraints can share their options.
         """
-        constraint_list = []
-        for constraint_data in dependency_data:
-            if isinstance(constraint_data, list):
-                constraint_list.append(
-                    self.parse_dependency_constraints(constraint_data))
-            else:
-                constraint_list.append(Constraint(constraint_data))
-        return constraint_list
+        return tuple(tuple(make_constraint(constraint_data)
+                           for constraint_data in list_data)
+                     if isinstance(list_data, list)
+                     else (make_constraint(list_data),)
+                     for list_data in dependency_data)
 
     def find_constraint_options(self, repository):
         """Uses the constraints and the repository to create self.conflicts
-        (a dictionary mapping package names to a list of conflicting Package
-        objects), and self.dependencies (a dictionary mapping package names to a
-        list of possible required Package objects).
+        (a frozenset of conflicting Package objects), and self.dependencies
+        (a tuple of tuples of possible required Package objects). The SAT
+        numbers of the dependencies are also stored in
+        self.dependency_sat_numbers, a tuple of tuples in the same shape.
 
         Also rationalises the dependency lists to remove any packages that
         conflict.
+
+        Packages with the same constraints share the same (immutable)
+        results, through repository.options.
         """
+        key = (self.conflict_constraints, self.dependency_constraints)
+        options = repository.options.get(key)
+        if options is not None:
+            (self.conflicts, self.dependencies,
+             self.dependency_sat_numbers) = options
+            return
+
+        # parse conflicts
+        conflicts = set()
+        for constraint in self.conflict_constraints:
+            conflicts.update(constraint.matches_in(repository))
+        self.conflicts = frozenset(conflicts)
+
         # parse dependencies
-        self.dependencies = []
+        dependencies = []
         for constraint_list in self.dependency_constraints:
             depends = []
             for constraint in constraint_list:
-                if constraint.name not in repository:
-                    continue
-                for package in repository[constraint.name]:
-                    if constraint.fulfilled_by(package):
-                        depends.append(package)
+                depends.extend(constraint.matches_in(repository))
             if len(depends) != 0:
-                self.dependencies.append(depends)
-
-        # parse conflicts
-        self.conflicts = []
-        for constraint in self.conflict_constraints:
-            if constraint.name not in repository:
-                continue
-            for package in repository[constraint.name]:
-                if constraint.fulfilled_by(package):
-                    self.conflicts.append(package)
-
-        # rationalise dependency list (if a dependency is a conflict, remove it)
-        for conflict in self.conflicts:
-            for depends_list in self.dependencies:
-                if conflict in depends_list:
-                    depends_list.remove(conflict)
+                # rationalise dependency list (if a dependency is a conflict,
+                # remove every copy of it), keeping the list even if it is now
+                # empty as the package can then never be installed
+                dependencies.append([package for package in depends
+                                     if package not in conflicts])
+        self.dependencies = tuple(map(tuple, dependencies))
+        self.dependency_sat_numbers = tuple(
+            tuple(map(get_sat_number, depends_list))
+            for depends_list in self.dependencies)
+        repository.options[key] = (self.conflicts, self.dependencies,
+                                   self.dependency_sat_numbers)
+
+    def __eq__(self, other):
+        # every Package object is unique, so compare by identity
+        return self is other
+
+    def __hash__(self):
+        return self.sat_number
 
     def __str__(self):
-        return self.name + "=" + ".".join(str(part) for part in self.version)
+        return self._str
 
     def __repr__(self):
         # debug
         return str(self)
 
 
-class Constraint(types.SimpleNamespace):
+class Constraint:
     # todo: docstring
-    CONSTRAINT_REGEX = re.compile(
-        r"(?P<name>[.+a-zA-Z0-9-]+)"
-        r"((?P<constraint>(=|<|>|<=|>=))(?P<version>[0-9.]+))?")
+    __slots__ = ("name", "constraint", "version")
+
+    OPERATORS = {"=", "<", ">", "<=", ">="}
+    """The valid constraint operators."""
 
     def __init__(self, constraint_data):
-        match = self.CONSTRAINT_REGEX.match(constraint_data)
-        if match is None:
+        # find the start of the operator, if there is one
+        start = len(constraint_data)
+        for character in "=<>":
+            index = constraint_data.find(character, 0, start)
+            if index != -1:
+                start = index
+
+        if start == len(constraint_data):
+            # just a package name
+            self.name = constraint_data
+            self.constraint = None
+            self.version = None
+            return
+
+        # operators are one character, or two if followed by "="
+        if constraint_data.startswith("=", start + 1):
+            end = start + 2
+        else:
+            end = start + 1
+        self.name = constraint_data[:start]
+        self.constraint = constraint_data[start:end]
+        version = constraint_data[end:]
+        if (self.name == "" or version == ""
+                or self.constraint not in self.OPERATORS):
             raise Exception("Constraint data invalid: "
                             + str(constraint_data))
-        group_dict = match.groupdict()
-        assert (group_dict["constraint"] is None) == (group_dict["version"] is None)
-
-        self.name = group_dict["name"]
-        self.constraint = group_dict["constraint"]
-        self.version = group_dict["version"]
-        if self.version is not None:
-            self.version = [int(part) for part in
-                            group_dict["version"].split(".")]
-
-    def fulfilled_by(self, package):
-        if self.name != package.name:
-            return False
-        if self.constraint is None and self.version is None:
-            return True
+
+        self.version = parse_version(version)
+
+    def matches_in(self, repository):
+        """Returns a tuple of the Package objects in the repository that fulfil
+        this constraint, in repository order.
+
+        Uses a lookup by name and version for "=", and otherwise a binary
+        search over the version-sorted packages, instead of testing every
+        version. Range results are cached in the repository, as many packages
+        share the same constraints.
+        """
+        if self.name not in repository:
+            return ()
+        if self.constraint is None:
+            return repository[self.name]
         if self.constraint == "=":
-            return package.version == self.version
+            return repository.by_name_version.get((self.name, self.version),
+                                                  ())
+        key = (self.name, self.constraint, self.version)
+        if key in repository.matches:
+            return repository.matches[key]
+
+        versions = repository.versions[self.name]
         if self.constraint == "<":
-            return package.version < self.version
-        if self.constraint == ">":
-            return package.version > self.version
-        if self.constraint == "<=":
-            return package.version <= self.version
-        if self.constraint == ">=":
-            return package.version >= self.version
-        raise NotImplementedError("Constraint '" + str(self.constraint)
-                                  + "' not recognised.")
+            start = 0
+            stop = bisect.bisect_left(versions, self.version)
+        elif self.constraint == ">":
+            start = bisect.bisect_right(versions, self.version)
+            stop = len(versions)
+        elif self.constraint == "<=":
+            start = 0
+            stop = bisect.bisect_right(versions, self.version)
+        elif self.constraint == ">=":
+            start = bisect.bisect_left(versions, self.version)
+            stop = len(versions)
+        else:
+            raise NotImplementedError("Constraint '" + str(self.constraint)
+                                      + "' not recognised.")
+        matches = tuple(sorted(repository.by_version[self.name][start:stop],
+                               key=get_sat_number))
+        repository.matches[key] = matches
+        return matches
 
     def __str__(self):
         result = self.name
@@ -172,174 +290,339 @@ class Constraint(types.SimpleNamespace):
         return self.__class__.__name__ + "(" + str(self) + ")"
 
 
+def parse_version(version):
+    """Returns the version tuple for the version string version.
+
+    The same tuple is shared by every package and constraint using the same
+    version string.
+    """
+    version_tuple = VERSION_CACHE.get(version)
+    if version_tuple is None:
+        version_tuple = tuple(map(int, version.split(".")))
+        VERSION_CACHE[version] = version_tuple
+    return version_tuple
+
+
+def make_constraint(constraint_data):
+    """Returns the Constraint object for constraint_data.
+
+    Constraints are never modified after construction, so the same object is
+    shared by every package using the same constraint string.
+    """
+    constraint = CONSTRAINT_CACHE.get(constraint_data)
+    if constraint is None:
+        constraint = Constraint(constraint_data)
+        CONSTRAINT_CACHE[constraint_data] = constraint
+    return constraint
+
+
+class Repository(dict):
+    """Container class mapping package names to a tuple of Package objects,
+    in repository order.
+
+    self.packages is the list of every package it was created from, where
+    the list index is the package's SAT number. Index 0 is None.
+
+    self.literals is a list of the string of every SAT literal, which can be
+    indexed by the (possibly negative) literal itself.
+
+    self.by_version holds the same tuples sorted by version, and
+    self.versions the matching tuples of versions, for use with bisect.
+
+    self.by_name_version maps each (name, version) pair to a tuple of its
+    Package objects, in repository order.
+
+    self.matches caches the results of Constraint.matches_in, by (name,
+    operator, version).
+
+    self.options caches the results of Package.find_constraint_options, by
+    the package's conflict and dependency constraints.
+    """
+    def __init__(self, packages):
+        super().__init__()
+        self.packages = packages
+        self.by_name_version = {}
+        for package in itertools.islice(packages, 1, None):
+            if package.name in self:
+                self[package.name].append(package)
+            else:
+                self[package.name] = [package]
+            key = (package.name, package.version)
+            if key in self.by_name_version:
+                self.by_name_version[key] += (package,)
+            else:
+                self.by_name_version[key] = (package,)
+
+        self.by_version = {}
+        self.versions = {}
+        self.matches = {}
+        self.options = {}
+        for name, package_versions in self.items():
+            self[name] = tuple(package_versions)
+            self.by_version[name] = tuple(
+                sorted(package_versions, key=lambda package: package.version))
+            self.versions[name] = tuple(
+                package.version for package in self.by_version[name])
+
+        # negative literals are at the end, so negative indexes find them
+        self.literals = ([str(n) for n in range(len(self.packages))]
+                         + [str(n) for n in range(1 - len(self.packages), 0)])
+
+
 def parse(repository_data, initial_data, constraints_data):
     # todo: docstring
     # parse repository_data
-    repository = {}
-    for package_data in repository_data:
-        package = Package(package_data)
-        if package.name in repository:
-            repository[package.name].append(package)
-        else:
-            repository[package.name] = [package]
-    for package_versions in repository.values():
-        for package in package_versions:
-            package.find_constraint_options(repository)
+    # allocate the list up front, index 0 is None as there is no SAT number 0
+    packages = [None] * (len(repository_data) + 1)
+    for sat_number, package_data in enumerate(repository_data, start=1):
+        packages[sat_number] = Package(package_data, sat_number)
+    repository = Repository(packages)
+    # constraints can name packages that come later in repository_data, so
+    # they can only be resolved once every package has been created
+    for package in itertools.islice(packages, 1, None):
+        package.find_constraint_options(repository)
 
     # parse initial_data
     # assuming all installed packages are available in the repository
-    initial = []
+    initial = set()
+    # (entries are always name=version, so look them up directly rather than
+    # creating a Constraint for each)
     for package_version in initial_data:
-        constraint = Constraint(package_version)
-        for package in repository[constraint.name]:
-            if constraint.fulfilled_by(package):
-                initial.append(package)
-                break
+        name, _, version = package_version.partition("=")
+        initial.update(repository.by_name_version.get(
+            (name, parse_version(version)), ())[:1])
 
     # parse constraints_data
-    uninstall = []
+    uninstall = set()
     install = []
     for constraint_data in constraints_data:
-        constraint = Constraint(constraint_data[1:])
+        constraint = make_constraint(constraint_data[1:])
         if constraint_data[0] == "-":
             assert constraint.name in repository
-            for package in repository[constraint.name]:
-                if constraint.fulfilled_by(package):
-                    uninstall.append(package)
-                    break
+            uninstall.update(constraint.matches_in(repository))
         else:
             install.append(constraint)
 
     return repository, initial, uninstall, install
 
 
-def install_dependencies(repository, initial, uninstall, package):
+def install_dependencies(installed, forbidden, uninstall, package):
     """Create the commands required to install the specified package including
     requirements. Selects dependencies based on their size.
 
+    installed, forbidden and uninstall are sets of SAT numbers, where
+    forbidden holds the packages conflicting with an installed package.
+    installed and forbidden are updated with the dependencies chosen.
+
     todo: include size of dependencies in calculation
     todo: look ahead to find conflicts instead of failing
     """
     commands = []
-    for dependency_list in package.dependencies:
-        smallest = None
-        for possible_dependency in dependency_list:
-            if possible_dependency in uninstall:
-                continue
-            for initial_package in initial:
-                if possible_dependency in initial_package.conflicts:
-                    break
-            else:
-                # package is not conflicting
-                if smallest is None or possible_dependency.size < smallest.size:
+    # explicit stack of (package, iterator over its dependency lists), used
+    # instead of recursion
+    stack = [(package, iter(package.dependencies))]
+    while len(stack) != 0:
+        current, dependency_lists = stack[-1]
+        for dependency_list in dependency_lists:
+            smallest = None
+            for possible_dependency in dependency_list:
+                if (possible_dependency.sat_number in uninstall
+                        or possible_dependency.sat_number in forbidden):
+                    continue
+                if (smallest is None
+                        or possible_dependency.size < smallest.size):
                     smallest = possible_dependency
-        if smallest is None:
-            # need to uninstall another package so this one can be installed
-            raise Exception("Failed to find package!")
-        if smallest not in initial:
-            initial.append(smallest)
-            commands.extend(install_dependencies(repository, initial, uninstall,
-                                                 smallest))
-            commands.append("+" + str(smallest))
+            if smallest is None:
+                # need to uninstall another package so this one can be
+                # installed
+                raise Exception("Failed to find package!")
+            if smallest.sat_number not in installed:
+                installed.add(smallest.sat_number)
+                forbidden.update(map(get_sat_number, smallest.conflicts))
+                # install the dependencies of smallest first
+                stack.append((smallest, iter(smallest.dependencies)))
+                break
+        else:
+            # all dependencies of current are installed
+            stack.pop()
+            if len(stack) != 0:
+                # the caller installs the top level package
+                commands.append("+" + str(current))
     return commands
 
 
 def old_solve(repository, initial, uninstall, install):
     # naive implementation:
     # will fail instead of uninstalling a conflicting package
+    # work with SAT numbers, which hash faster than Package objects
+    installed = {package.sat_number for package in initial}
+    uninstall_numbers = {package.sat_number for package in uninstall}
     commands = []
 
     for package in uninstall:
-        if package in initial:
+        if package.sat_number in installed:
             commands.append("-" + str(package))
-            initial.remove(package)
+            installed.discard(package.sat_number)
+
+    # packages conflicting with an installed package, kept up to date as
+    # packages are installed
+    forbidden = set()
+    for installed_number in installed:
+        forbidden.update(map(get_sat_number,
+                             repository.packages[installed_number].conflicts))
 
     for constraint in install:
         # todo: include size of dependencies in calculation
-        smallest = None
-        for potential_package in repository[constraint.name]:
-            if potential_package in uninstall:
-                continue
-            if not constraint.fulfilled_by(potential_package):
-                continue
-            for initial_package in initial:
-                if potential_package in initial_package.conflicts:
-                    break
-            else:
-                # package is not conflicting
-                if smallest is None or potential_package.size < smallest.size:
-                    smallest = potential_package
-        if smallest is None:
+        allowed = [package for package in constraint.matches_in(repository)
+                   if package.sat_number not in uninstall_numbers
+                   and package.sat_number not in forbidden]
+        if len(allowed) == 0:
             # need to uninstall another package so this one can be installed
             raise Exception("Failed to find package!")
-        if smallest in initial:
+        # min keeps the first of equally small packages
+        smallest = min(allowed, key=get_size)
+        if smallest.sat_number in installed:
             continue
-        initial.append(smallest)
-        commands.extend(install_dependencies(repository, initial, uninstall,
-                                             smallest))
+        installed.add(smallest.sat_number)
+        forbidden.update(map(get_sat_number, smallest.conflicts))
+        commands.extend(install_dependencies(installed, forbidden,
+                                             uninstall_numbers, smallest))
         commands.append("+" + str(smallest))
 
     return commands
 
 
 def toposort(nodes, count):
+    """Sorts the graph nodes (a dictionary mapping each node to a list of
+    outgoing nodes) using count (a dictionary mapping each node to its number
+    of incoming edges).
+
+    Nodes with no remaining incoming edges are output smallest first.
+    """
+    heappush = heapq.heappush
+    heappop = heapq.heappop
     output = []
-    to_remove = []
-    # initialise list of nodes with no incoming edges
-    for node in nodes.keys():
-        if count[node] == 0:
-            to_remove.append(node)
+    append = output.append
+    # initialise heap of nodes with no incoming edges
+    to_remove = [node for node in nodes if count[node] == 0]
+    heapq.heapify(to_remove)
 
     # create output list
     for _ in range(len(nodes)):
-        if len(to_remove) == 0:
-            raise ToposortError
-        node = to_remove.pop(0)
-        output.append(node)
+        if not to_remove:
+            raise ToposortError(find_cycles(nodes, nodes.keys() - output))
+        node = heappop(to_remove)
+        append(node)
         for outgoing_node in nodes[node]:
-            count[outgoing_node] -= 1
-            if count[outgoing_node] == 0 and outgoing_node not in to_remove:
-                bisect.insort(to_remove, outgoing_node)
+            remaining = count[outgoing_node] - 1
+            count[outgoing_node] = remaining
+            # a node's count only reaches 0 once, so it is never queued twice
+            if remaining == 0:
+                heappush(to_remove, outgoing_node)
 
     return output
 
 
-def problem_to_cnf(repository, uninstall, install):
-    """Converts the problem to DIMACS CNF form, for passing to a SAT solver."""
-    output = ["c Normal SAT form\n"]
+def find_cycles(nodes, remaining):
+    """Finds the cycles between the remaining nodes of the graph (a dictionary
+    mapping each node to a list of outgoing nodes), using an iterative form of
+    Tarjan's strongly connected components algorithm.
+
+    Returns a list of the strongly connected components that contain a cycle,
+    each a sorted list of nodes.
+    """
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+    for root in sorted(remaining):
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        # explicit stack of (node, iterator over its outgoing nodes), used
+        # instead of recursion
+        work = [(root, iter(nodes[root]))]
+        while len(work) != 0:
+            node, outgoing_nodes = work[-1]
+            for outgoing_node in outgoing_nodes:
+                if outgoing_node not in remaining:
+                    continue
+                if outgoing_node not in index:
+                    index[outgoing_node] = low[outgoing_node] = len(index)
+                    stack.append(outgoing_node)
+                    on_stack.add(outgoing_node)
+                    work.append((outgoing_node, iter(nodes[outgoing_node])))
+                    break
+                if outgoing_node in on_stack:
+                    low[node] = min(low[node], index[outgoing_node])
+            else:
+                # all outgoing nodes visited
+                work.pop()
+                if len(work) != 0:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    # node is the root of a strongly connected component
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 or node in nodes[node]:
+                        cycles.append(sorted(component))
+    return cycles
+
+
+def cnf_clauses(repository, uninstall, install):
+    """Yields the clauses of the problem as tuples of literals, so
+    problem_to_cnf can write each clause as it is produced rather than
+    holding them all in memory.
+    """
     # encode conflicts and dependencies of repository
     for package_versions in repository.values():
         for package in package_versions:
+            not_package = -package.sat_number
+
             # A conflicts B -> !A OR !B
+            # (if B also conflicts A, only the package with the smaller SAT
+            # number yields the clause)
             for conflict in package.conflicts:
-                output.append(str(-package.sat_number) + " "
-                              + str(-conflict.sat_number) + " 0\n")
+                if (conflict.sat_number < package.sat_number
+                        and package in conflict.conflicts):
+                    continue
+                yield not_package, -conflict.sat_number
 
-            for dependency_list in package.dependencies:
-                # A requires B or C -> !A OR B OR C
-                sub_clause = [-package.sat_number]
-                for possible_dependency in dependency_list:
-                    sub_clause.append(possible_dependency.sat_number)
-                output.append(" ".join(str(s) for s in sub_clause) + " 0\n")
+            # A requires B or C -> !A OR B OR C
+            for dependency_list in package.dependency_sat_numbers:
+                yield (not_package,) + dependency_list
 
     # encode uninstall constraints
-    for package in uninstall:
-        output.append(str(-package.sat_number) + " 0\n")
+    for sat_number in map(get_sat_number, uninstall):
+        yield (-sat_number,)
 
     # encode install constraints
     for constraint in install:
-        sub_clause = []
-        for package in repository[constraint.name]:
-            if constraint.fulfilled_by(package):
-                sub_clause.append(package.sat_number)
-        output.append(" ".join(str(s) for s in sub_clause) + " 0\n")
+        yield tuple(map(get_sat_number, constraint.matches_in(repository)))
 
-    # add problem line
-    output.insert(1, "p cnf {} {} \n".format(
-        len(SAT_NUMBER) - 1,  # number of variables (subtract None value)
-        len(output) - 1))  # number of clauses (subtract comment line)
 
-    return output
+def problem_to_cnf(repository, uninstall, install, weight_prefix=""):
+    """Converts the problem to DIMACS CNF form, for passing to a SAT solver.
+
+    weight_prefix is written before every clause, to use them as the hard
+    clauses of a weighted form.
+    """
+    cnf = CNF("Normal SAT form",
+              len(repository.packages) - 1)  # subtract None
+    literals = repository.literals
+
+    cnf.add_clauses(weight_prefix + " ".join(map(literals.__getitem__, clause))
+                    for clause in cnf_clauses(repository, uninstall, install))
+    return cnf
 
 
 def problem_to_wcnf(repository, initial, uninstall, install):
@@ -347,62 +630,62 @@ def problem_to_wcnf(repository, initial, uninstall, install):
 
     More specifically, in Weighted Partial Max-SAT form.
     """
-    output = problem_to_cnf(repository, uninstall, install)
-
-    # convert cnf to wcnf
-    for i, clause in enumerate(output):
-        if i == 0:
-            output[i] = "c Weighted Partial Max-SAT form\n"
-        elif i == 1:
-            # convert problem line later
-            pass
-        else:
-            output[i] = MAX_WEIGHT_STR + output[i]
+    wcnf = problem_to_cnf(repository, uninstall, install, MAX_WEIGHT_STR)
+    wcnf.comment = "Weighted Partial Max-SAT form"
+    wcnf.top_weight = MAX_WEIGHT
+    literals = repository.literals
 
     # encode cost to install package
-    for package_versions in repository.values():
-        for package in package_versions:
-            # since this is a MAX-SAT, the package size is awarded for not
-            # installing the package
-            output.append(str(package.size) + " " + str(-package.sat_number)
-                          + " 0\n")
+    # since this is a MAX-SAT, the package size is awarded for not installing
+    # the package
+    wcnf.add_clauses(str(package.size) + " " + literals[-package.sat_number]
+                     for package in
+                     itertools.chain.from_iterable(repository.values()))
 
     # encode initial state
-    for package in initial:
-        # since this is a MAX-SAT, the uninstall cost is awarded for keeping
-        # these packages installed
-        output.append(UNINSTALL_COST_STR + str(package.sat_number) + " 0\n")
-
-    # convert problem line
-    output[1] = "p wcnf {} {} {}\n".format(
-        len(SAT_NUMBER) - 1,  # number of variables (subtract None value)
-        len(output) - 2,  # number of clauses (subtract 'c' and 'p' lines)
-        MAX_WEIGHT)
-
-    return output
-
-
-def run_solver(cnf):
-    # write to file
-    with open("Edward-Knight.cnf", "w") as f:
-        f.writelines(cnf)
-
-    # run open-wbo
+    # since this is a MAX-SAT, the uninstall cost is awarded for keeping these
+    # packages installed
+    wcnf.add_clauses(UNINSTALL_COST_STR + literals[package.sat_number]
+                     for package in initial)
+
+    return wcnf
+
+
+def run_solver(cnf, packages):
+    # run open-wbo, piping the problem in rather than going through a file
+    process = subprocess.Popen(
+        ["open-wbo/open-wbo_static", "/dev/stdin"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+    # if open-wbo exits before reading the whole problem, carry on and read
+    # its output, so the failure is reported through SATError
+    try:
+        process.stdin.write(str(cnf).encode("utf-8"))
+    except BrokenPipeError:
+        pass
     try:
-        output = subprocess.check_output(
-            ["open-wbo/open-wbo_static", "Edward-Knight.cnf"],
-            stderr=subprocess.PIPE).decode("utf-8").splitlines()
-    except subprocess.CalledProcessError as e:
-        output = e.output.decode("utf-8").splitlines()
-
-    # get output
-    if str(output[-1][0]) != "v":
-        raise SATError("\n" + "\n".join(output))
-    sat_numbers = [int(n) for n in output[-1][2:].split(" ")[:-1]]
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+
+    # read output line by line, the model is given as "v <literals>" and
+    # everything else is only kept to report a failure
+    # (parsed as bytes, as int accepts them directly)
+    model = None
+    messages = []
+    for line in process.stdout:
+        if line.startswith(b"v"):
+            model = line
+        else:
+            messages.append(line)
+    process.stdout.close()
+    process.wait()
+    if model is None:
+        raise SATError("\n" + b"".join(messages).decode("utf-8").rstrip())
     add_p = []
     remove_p = []
-    for sat_number in sat_numbers:
-        package = SAT_NUMBER[abs(sat_number)]
+    for sat_number in map(int, model[1:].split()):
+        package = packages[abs(sat_number)]
         if sat_number > 0:
             add_p.append(package)
         else:
@@ -414,56 +697,62 @@ def run_solver(cnf):
 
 def remove_p_to_commands(remove_p, initial):
     # rationalise remove_p, taking initial state into account
-    remove_p = [p for p in remove_p if p in initial]
+    # (remove_p holds every package the solver left out, so compare SAT
+    # numbers rather than calling Package.__hash__ for each)
+    initial_numbers = set(map(get_sat_number, initial))
+    remove_p = [p for p in remove_p if p.sat_number in initial_numbers]
 
     # sort the commands in the correct uninstall order
     # build graph structure for toposort
     nodes = {p.sat_number: [] for p in remove_p}
     count = {p.sat_number: 0 for p in remove_p}
     for package in remove_p:
-        # add outgoing edges based on dependencies
-        for dependency_list in package.dependencies:
-            for dependency in dependency_list:
-                if dependency in remove_p:
-                    nodes[dependency.sat_number].append(package.sat_number)
-                    count[package.sat_number] += 1
+        # add outgoing edges based on (all alternatives of) dependencies
+        # (a package depending on itself does not constrain the order)
+        for dependency in itertools.chain.from_iterable(
+                package.dependency_sat_numbers):
+            if dependency in nodes and dependency != package.sat_number:
+                nodes[dependency].append(package.sat_number)
+                count[package.sat_number] += 1
 
     # toposort!
     remove_sat_numbers = list(reversed(toposort(nodes, count)))
 
     # convert to commands
-    commands = ["-" + str(SAT_NUMBER[n]) for n in remove_sat_numbers]
+    packages = {p.sat_number: p for p in remove_p}
+    commands = ["-" + str(packages[n]) for n in remove_sat_numbers]
 
-    # update initial state
-    initial = [p for p in initial if p not in remove_p]
+    # update initial state (a new set, as the caller may retry with the old)
+    initial = initial.difference(remove_p)
 
     return commands, initial
 
 
 def add_p_to_commands(add_p, initial):
     # rationalise add_p, taking initial state into account
-    add_p = [p for p in add_p if p not in initial]
+    initial_numbers = set(map(get_sat_number, initial))
+    add_p = [p for p in add_p if p.sat_number not in initial_numbers]
 
     # sort the commands in the correct install order
-    # build graph structure for toposort
+    # build graph structure for toposort, working with SAT numbers
     nodes = {p.sat_number: [] for p in add_p}
     count = {p.sat_number: 0 for p in add_p}
     for package in add_p:
         # add outgoing edges based on dependencies
-        for dependency_list in package.dependencies:
+        for dependency_list in package.dependency_sat_numbers:
             fulfilled = False
             for dependency in dependency_list:
-                if dependency in initial:
+                if dependency in initial_numbers:
                     # dependency fulfilled by initial
                     fulfilled = True
                     break
             if not fulfilled:
                 # dependency not fulfilled by initial
                 for dependency in dependency_list:
-                    if dependency in add_p:
+                    if dependency in nodes:
                         # dependency fulfilled by new install
                         # add edge to graph
-                        nodes[dependency.sat_number].append(package.sat_number)
+                        nodes[dependency].append(package.sat_number)
                         count[package.sat_number] += 1
                         fulfilled = True
                         break
@@ -475,21 +764,59 @@ def add_p_to_commands(add_p, initial):
     add_sat_numbers = toposort(nodes, count)
 
     # convert to commands
-    commands = ["+" + str(SAT_NUMBER[n]) for n in add_sat_numbers]
+    packages = {p.sat_number: p for p in add_p}
+    commands = ["+" + str(packages[n]) for n in add_sat_numbers]
 
     # update initial state
-    initial = initial[:] + [p for p in add_p]
+    initial.update(add_p)
 
     return commands, initial
 
 
-def solve_cnf(repository, initial, uninstall, install):
-    """Solve the problem with a normal SAT solver."""
-    cnf = problem_to_cnf(repository, uninstall, install)
+def cycle_clause(packages, cycle, add_numbers, initial_numbers):
+    """Creates a clause disallowing a dependency cycle found by
+    add_p_to_commands, as a list of literals.
+
+    cycle is a list of SAT numbers of packages to install, add_numbers the SAT
+    numbers of all the packages to install and initial_numbers the SAT numbers
+    of the packages kept installed. The cycle remains while all of its
+    packages are installed, unless one of the dependencies it was built from
+    is fulfilled by a package outside add_numbers instead.
+    """
+    members = set(cycle)
+    alternatives = set()
+    for sat_number in cycle:
+        for dependency_list in packages[sat_number].dependency_sat_numbers:
+            if any(dependency in initial_numbers
+                   for dependency in dependency_list):
+                # dependency fulfilled by initial, so no edge
+                continue
+            for dependency in dependency_list:
+                if dependency in add_numbers:
+                    break
+            else:
+                continue
+            if dependency in members:
+                # an edge of the cycle, broken by installing any alternative
+                # that is not to be installed now
+                alternatives.update(alternative
+                                    for alternative in dependency_list
+                                    if alternative not in add_numbers)
+    return [-sat_number for sat_number in cycle] + sorted(alternatives)
+
 
+def solve_loop(repository, initial, cnf, retry_prefix=""):
+    """Run the solver on cnf until its solution can be ordered into commands.
+
+    Solutions with a dependency cycle are disallowed, along with each cycle
+    found in them, by adding clauses with retry_prefix (the weight for a WCNF
+    problem) prepended, and the solver is run again.
+    """
+    packages = repository.packages
+    literals = repository.literals
     while True:
         # run solver
-        remove_p, add_p = run_solver(cnf)
+        remove_p, add_p = run_solver(cnf, packages)
 
         # convert remove_p to commands
         remove_commands, new_initial = remove_p_to_commands(remove_p, initial)
@@ -498,40 +825,36 @@ def solve_cnf(repository, initial, uninstall, install):
         try:
             add_commands, new_initial = add_p_to_commands(add_p, new_initial)
             break
-        except ToposortError:
+        except ToposortError as error:
             print("ToposortError, trying again...", file=sys.stderr)
-            # dependency cycle, try again
-            # disallow this solution by inverting it and adding it as a clause
-            cnf.append(" ".join(str(-p.sat_number) for p in add_p) + " 0\n")
-            # todo: update problem line with extra clause
+            # dependency cycles, try again
+            # disallow this solution by inverting it and adding it as a
+            # clause, and disallow every cycle found in it so the solver is
+            # not rerun once per cycle
+            initial_numbers = set(map(get_sat_number, new_initial))
+            add_numbers = {p.sat_number for p in add_p
+                           if p.sat_number not in initial_numbers}
+            cnf.add_clause(retry_prefix + " ".join(
+                [literals[-p.sat_number] for p in add_p]))
+            for cycle in error.cycles:
+                clause = cycle_clause(packages, cycle, add_numbers,
+                                      initial_numbers)
+                cnf.add_clause(retry_prefix + " ".join(
+                    map(literals.__getitem__, clause)))
 
     return remove_commands + add_commands
 
 
+def solve_cnf(repository, initial, uninstall, install):
+    """Solve the problem with a normal SAT solver."""
+    cnf = problem_to_cnf(repository, uninstall, install)
+    return solve_loop(repository, initial, cnf)
+
+
 def solve_wcnf(repository, initial, uninstall, install):
     """Solve the problem with a weighted partial Max-SAT solver."""
     wcnf = problem_to_wcnf(repository, initial, uninstall, install)
-
-    while True:
-        # run solver
-        remove_p, add_p = run_solver(wcnf)
-
-        # convert remove_p to commands
-        remove_commands, new_initial = remove_p_to_commands(remove_p, initial)
-
-        # convert add_p to commands
-        try:
-            add_commands, new_initial = add_p_to_commands(add_p, new_initial)
-            break
-        except ToposortError:
-            print("ToposortError, trying again...", file=sys.stderr)
-            # dependency cycle, try again
-            # disallow this solution by inverting it and adding it as a clause
-            wcnf.append(MAX_WEIGHT_STR
-                        + " ".join(str(-p.sat_number) for p in add_p) + " 0\n")
-            # todo: update problem line with extra clause
-
-    return remove_commands + add_commands
+    return solve_loop(repository, initial, wcnf, MAX_WEIGHT_STR)
 
 
 def main():
@@ -544,19 +867,31 @@ def main():
     parser.add_argument("repository_data", type=json_from_file)
     parser.add_argument("initial_data", type=json_from_file)
     parser.add_argument("constraints_data", type=json_from_file)
+    parser.add_argument(
+        "--backend", choices=("auto", "wcnf", "cnf"), default="auto",
+        help="solve as weighted partial Max-SAT (wcnf) or plain SAT (cnf), "
+             "by default chosen by repository size")
     args = parser.parse_args()
 
-    repository, initial, uninstall, install = parse(**args.__dict__)
-    if len(SAT_NUMBER) < 50000:  # arbitrary choice
+    repository, initial, uninstall, install = parse(
+        args.repository_data, args.initial_data, args.constraints_data)
+    backend = args.backend
+    if backend == "auto":
+        if len(repository.packages) < 50000:  # arbitrary choice
+            backend = "wcnf"
+        else:
+            # note: this path doesn't seem to provide a much better
+            # alternative
+            backend = "cnf"
+    if backend == "wcnf":
         commands = solve_wcnf(repository, initial, uninstall, install)
     else:
-        # note: this path doesn't seem to provide a much better alternative
         commands = solve_cnf(repository, initial, uninstall, install)
 
-    json.dump(commands, sys.stdout)
+    # encode in one go with the C encoder, then write once
+    sys.stdout.write(json.dumps(commands))
     sys.stdout.flush()
 
 
 if __name__ == "__main__":
-    sys.setrecursionlimit(100000)  # lol
     main()